@@ -1,12 +1,17 @@
 import logging
+import numpy as np
 import re
-from geopandas import GeoDataFrame, read_file
-from glob import glob
-from os.path import join
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from geopandas import GeoDataFrame, GeoSeries, read_file, read_parquet
+from hashlib import md5
+from os import makedirs, remove, replace, scandir
+from os.path import exists, join
+from pandas import Categorical, concat
 from pandas.api.types import is_numeric_dtype
+from pandas.util import hash_pandas_object
+from pyogrio import write_dataframe
 from shapely.geometry import MultiPolygon
-from shapely.validation import make_valid
-from topojson import Topology
 from zipfile import BadZipFile, ZipFile
 
 from hdx.data.dataset import Dataset
@@ -16,6 +21,16 @@ from hdx.utilities.uuid import get_uuid
 
 logger = logging.getLogger()
 
+_POLBND_RE = re.compile(r"polbnd[ap]_adm(\d)")
+_RESOURCE_ADM_RE = {
+    str(l): re.compile(rf".*adm(in)?(\s)?(0)?{l}.*", re.IGNORECASE) for l in range(10)
+}
+_ADM_RE = {
+    str(l): re.compile(rf".*admbnda.*adm(in)?(0)?{l}.*", re.IGNORECASE) for l in range(10)
+}
+_SIMP_RE = re.compile(r".*simplified.*", re.IGNORECASE)
+_SHAPEFILE_EXTENSIONS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
 
 def drop_fields(df, keep_fields):
     df = df.drop(
@@ -25,20 +40,83 @@ def drop_fields(df, keep_fields):
     return df
 
 
+def dissolve_fields(df, by):
+    # group on a single hashed key rather than on the text columns themselves
+    df = df.dropna(subset=by)
+    key = hash_pandas_object(df[by], index=False).to_numpy()
+    grouped = df.groupby(key, sort=False)
+    geometry = [
+        shapely.union_all(geoms.values) for _, geoms in grouped[df.geometry.name]
+    ]
+    df = GeoDataFrame(
+        grouped[by].first().reset_index(drop=True),
+        geometry=geometry,
+        crs=df.crs,
+    )
+    return df
+
+
+def validate_geometry(lyr, name):
+    geoms = np.array(lyr.geometry.values, dtype=object)
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        logger.info(f"Fixing {invalid.sum()} invalid geometries in {name}")
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+        lyr = lyr.set_geometry(GeoSeries(geoms, index=lyr.index, crs=lyr.crs))
+    return lyr
+
+
+def find_files(folder, extension):
+    found = []
+    folders = [folder]
+    while folders:
+        with scandir(folders.pop()) as entries:
+            for entry in entries:
+                # skip hidden entries as glob did, e.g. macOS ._ AppleDouble files
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith(extension):
+                    found.append(entry.path)
+    return found
+
+
+def keep_polygon_parts(geoms):
+    # rebuild geometry collections from their polygon parts only
+    parts, index = shapely.get_parts(geoms, return_index=True)
+    is_polygon = np.isin(
+        shapely.get_type_id(parts),
+        [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON],
+    )
+    polygons, part_index = shapely.get_parts(parts[is_polygon], return_index=True)
+    new_geoms = np.full(len(geoms), MultiPolygon(), dtype=object)
+    shapely.multipolygons(polygons, indices=index[is_polygon][part_index], out=new_geoms)
+    single = shapely.get_num_geometries(new_geoms) == 1
+    new_geoms[single] = shapely.get_geometry(new_geoms[single], 0)
+    return new_geoms
+
+
 class Boundaries:
     def __init__(
         self, configuration, downloader, temp_folder
     ):
         self.downloader = downloader
         self.boundaries = dict()
+        self.datasets = dict()
+        self._pending_updates = dict()
         self.UN_boundary = configuration["UN_boundaries"]["dataset"]
         self.boundary_names = configuration["UN_boundaries"]["resources"]
         self.temp_folder = temp_folder
+        self.cache_folder = configuration.get("input_cache_folder")
         self.exceptions = {
             "dataset": configuration.get("dataset_exceptions", {}),
             "resource": configuration.get("resource_exceptions", {}),
         }
         self.headers = configuration["shapefile_attribute_mappings"]
+        self._iso_codes = dict()
+        self._water_tree = None
+        self._water_geoms = None
 
     def download_boundary_inputs(self, levels):
         logger.info("Downloading boundaries")
@@ -47,46 +125,108 @@ class Boundaries:
         for resource in dataset.get_resources():
             if not resource["name"] in self.boundary_names.keys():
                 continue
-            if bool(re.match("polbnd[ap]_adm\d", resource["name"])) and not re.search("adm\d", resource["name"]).group() in levels:
+            polbnd_match = _POLBND_RE.match(resource["name"])
+            if polbnd_match and f"adm{polbnd_match.group(1)}" not in levels:
                 continue
-            _, resource_file = resource.download(folder=self.temp_folder)
-            lyr = read_file(resource_file)
-            all_boundaries[self.boundary_names[resource["name"]]] = lyr
+            all_boundaries[self.boundary_names[resource["name"]]] = self.read_boundary_input(resource)
+
+        # categorical iso columns so per-country filters compare integer codes
+        for lyr in all_boundaries.values():
+            if "alpha_3" in lyr.columns:
+                lyr["alpha_3"] = lyr["alpha_3"].astype("category")
+        adm0 = all_boundaries["adm0_polygon"]
+        adm0["ISO_3"] = adm0["ISO_3"].astype("category")
+        self._iso_codes = {iso: code for code, iso in enumerate(adm0["ISO_3"].cat.categories)}
 
         self.boundaries = all_boundaries
+        self._water_geoms = np.array(self.boundaries["water"].geometry.values, dtype=object)
+        self._water_tree = shapely.STRtree(self._water_geoms)
+
+    def read_boundary_input(self, resource):
+        # reuse the parsed layer from the cache if the HDX resource has not changed
+        cache_file = None
+        if self.cache_folder:
+            cache_key = md5(f"{resource['id']}{resource.get('last_modified', '')}".encode()).hexdigest()
+            cache_file = join(self.cache_folder, f"{self.boundary_names[resource['name']]}_{cache_key}.parquet")
+            if exists(cache_file):
+                logger.info(f"Reading {resource['name']} from cache")
+                # older cache files may hold unvalidated layers, so always check
+                return validate_geometry(read_parquet(cache_file), resource["name"])
+
+        _, resource_file = resource.download(folder=self.temp_folder)
+        lyr = validate_geometry(read_file(resource_file, engine="pyogrio"), resource["name"])
+        if cache_file:
+            self.write_boundary_cache(lyr, self.boundary_names[resource["name"]], cache_file)
+        return lyr
+
+    def write_boundary_cache(self, lyr, layer_name, cache_file):
+        # drop outdated copies of the layer, then write via a temp file so a failed run
+        # cannot leave a truncated parquet behind
+        makedirs(self.cache_folder, exist_ok=True)
+        with scandir(self.cache_folder) as entries:
+            for entry in entries:
+                # the md5 key has no underscores, so the layer name is everything before the last one
+                cached_name = entry.name.split(".parquet")[0].rsplit("_", 1)[0]
+                if cached_name == layer_name and ".parquet" in entry.name:
+                    remove(entry.path)
+        temp_file = f"{cache_file}.tmp"
+        lyr.to_parquet(temp_file)
+        replace(temp_file, cache_file)
 
     def create_national_boundary(self, iso):
         # select single country boundary (including disputed areas), cut out water, and dissolve
-        country_adm0 = self.boundaries["adm0_polygon"].copy(deep=True)
-        country_adm0 = country_adm0.loc[country_adm0["ISO_3"] == iso]
-        country_adm0 = country_adm0.overlay(self.boundaries["water"], how="difference")
+        global_adm0 = self.boundaries["adm0_polygon"]
+        country_rows = np.zeros(len(global_adm0), dtype=bool)
+        if iso in self._iso_codes:
+            country_rows = global_adm0["ISO_3"].cat.codes.to_numpy() == self._iso_codes[iso]
+        country_adm0 = global_adm0.loc[country_rows]
+        _, idxs = self._water_tree.query(country_adm0.geometry.values, predicate="intersects")
+        water_subset = shapely.union_all(self._water_geoms[np.unique(idxs)])
+        country_adm0 = country_adm0.set_geometry(
+            GeoSeries(
+                shapely.difference(country_adm0.geometry.values, water_subset),
+                index=country_adm0.index,
+                crs=country_adm0.crs,
+            )
+        )
+        country_adm0 = country_adm0.loc[~country_adm0.geometry.is_empty]
         country_adm0 = country_adm0.dissolve()
         country_adm0 = drop_fields(country_adm0, ["ISO_3"])
         country_adm0["ISO_3"] = iso
         if not country_adm0.crs:
             country_adm0 = country_adm0.set_crs(crs="EPSG:4326")
-        if not country_adm0["geometry"][0].is_valid:
-            country_adm0.loc[0, "geometry"] = make_valid(country_adm0.loc[0, "geometry"])
         return country_adm0
 
+    def read_boundary_dataset(self, iso):
+        dataset_name = self.exceptions["dataset"].get(iso, f"cod-em-{iso.lower()}")
+        dataset = Dataset.read_from_hdx(dataset_name)
+        if not dataset:
+            dataset = Dataset.read_from_hdx(f"cod-ab-{iso.lower()}")
+        return dataset
+
+    def find_boundary_datasets(self, countries, do_not_process):
+        logger.info("Finding boundary datasets")
+        isos = [
+            country["#country+code+v_iso3"]
+            for country in countries.values()
+            if country["#country+code+v_iso3"] not in do_not_process
+        ]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            datasets = executor.map(self.read_boundary_dataset, isos)
+        self.datasets = dict(zip(isos, datasets))
+
     def find_resource(self, iso, dataset, level):
         resource_name = self.exceptions["resource"].get(iso, "adm")
+        resource_re = re.compile(rf".*{re.escape(resource_name)}.*", re.IGNORECASE)
         boundary_resource = [
             r
             for r in dataset.get_resources()
-            if r.get_file_type() == "shp"
-            and bool(re.match(f".*{resource_name}.*", r["name"], re.IGNORECASE))
+            if r.get_file_type() == "shp" and resource_re.match(r["name"])
         ]
 
         if len(boundary_resource) > 1:
-            name_match = [
-                bool(re.match(f".*adm(in)?(\s)?(0)?{level[-1]}.*", r["name"], re.IGNORECASE))
-                for r in boundary_resource
-            ]
             boundary_resource = [
-                boundary_resource[i]
-                for i in range(len(boundary_resource))
-                if name_match[i]
+                r for r in boundary_resource if _RESOURCE_ADM_RE[level[-1]].match(r["name"])
             ]
         return boundary_resource
 
@@ -98,30 +238,30 @@ class Boundaries:
             return None
 
         temp_folder = join(self.temp_folder, get_uuid())
+        makedirs(temp_folder, exist_ok=True)
         try:
             with ZipFile(resource_file, "r") as z:
-                z.extractall(temp_folder)
+                for name in z.namelist():
+                    if name.lower().endswith(_SHAPEFILE_EXTENSIONS):
+                        z.extract(name, temp_folder)
         except BadZipFile:
             logger.error(f"{iso}: Could not unzip {level} file - it might not be a zip!")
             return None
 
-        boundary_shp = glob(join(temp_folder, "**", "*.shp"), recursive=True)
+        boundary_shp = find_files(temp_folder, ".shp")
         if len(boundary_shp) == 0:
             logger.error(f"{iso}: Did not find an {level} shapefile!")
             return None
 
         if len(boundary_shp) > 1:
-            name_match = [
-                bool(re.match(f".*admbnda.*adm(in)?(0)?{level[-1]}.*", b, re.IGNORECASE))
-                for b in boundary_shp
-            ]
-            if any(name_match):
-                boundary_shp = [boundary_shp[i] for i in range(len(boundary_shp)) if name_match[i]]
+            name_match = [b for b in boundary_shp if _ADM_RE[level[-1]].match(b)]
+            if name_match:
+                boundary_shp = name_match
 
         if len(boundary_shp) > 1:
-            simp_match = [bool(re.match(".*simplified.*", b, re.IGNORECASE)) for b in boundary_shp]
-            if any(simp_match):
-                boundary_shp = [boundary_shp[i] for i in range(len(boundary_shp)) if not simp_match[i]]
+            not_simplified = [b for b in boundary_shp if not _SIMP_RE.match(b)]
+            if len(not_simplified) < len(boundary_shp):
+                boundary_shp = not_simplified
 
         if len(boundary_shp) != 1:
             logger.error(f"{iso}: Could not distinguish between {level} downloaded shapefiles")
@@ -130,23 +270,25 @@ class Boundaries:
         return boundary_shp[0]
 
     def calculate_fields(self, boundary_lyr, iso, country_name, req_fields, level):
-        boundary_lyr["alpha_3"] = iso.upper()
-        boundary_lyr["ADM0_REF"] = country_name
+        zeros = np.zeros(len(boundary_lyr), dtype=np.int8)
+        boundary_lyr["alpha_3"] = Categorical.from_codes(zeros, categories=[iso.upper()])
+        boundary_lyr["ADM0_REF"] = Categorical.from_codes(zeros, categories=[country_name])
 
         fields = boundary_lyr.columns
+        upper_fields = np.char.upper(np.asarray(fields, dtype=str))
         for l in range(1, int(level[-1]) + 1):
-            possible_pcode_fields = [field.replace("#", str(l)) for field in self.headers["pcode"]]
-            possible_name_fields = [field.replace("#", str(l)) for field in self.headers["name"]]
+            possible_pcode_fields = {field.replace("#", str(l)) for field in self.headers["pcode"]}
+            possible_name_fields = {field.replace("#", str(l)) for field in self.headers["name"]}
             pcode_field = None
             name_field = None
             if f"ADM{l}_PCODE" in fields:
                 pcode_field = f"ADM{l}_PCODE"
             if f"ADM{l}_EN" in fields:
                 name_field = f"ADM{l}_EN"
-            for field in fields:
-                if not pcode_field and field.upper() in possible_pcode_fields:
+            for field, upper_field in zip(fields, upper_fields):
+                if not pcode_field and upper_field in possible_pcode_fields:
                     pcode_field = field
-                if not name_field and field.upper() in possible_name_fields:
+                if not name_field and upper_field in possible_name_fields:
                     name_field = field
 
             if not name_field:
@@ -161,74 +303,94 @@ class Boundaries:
                 boundary_lyr[f"ADM{l}_PCODE"] = ""
             if pcode_field:
                 if is_numeric_dtype(boundary_lyr[pcode_field]):
-                    boundary_lyr[f"ADM{l}_PCODE"] = (
-                        boundary_lyr[pcode_field].astype(int).astype(str)
+                    boundary_lyr[f"ADM{l}_PCODE"] = np.char.mod(
+                        "%d", boundary_lyr[pcode_field].to_numpy(dtype=np.int64)
                     )
                 else:
                     boundary_lyr[f"ADM{l}_PCODE"] = boundary_lyr[pcode_field]
 
         boundary_lyr = drop_fields(boundary_lyr, req_fields)
-        boundary_lyr = boundary_lyr.dissolve(by=req_fields, as_index=False)
+        boundary_lyr = dissolve_fields(boundary_lyr, req_fields)
         return boundary_lyr
 
     def update_geometry(self, boundary_lyr, country_adm0, iso, level):
         # simplify geometry of boundaries
-        boundary_topo = Topology(boundary_lyr)
         eps = 0.0075
         if int(level[-1]) > 0:
             eps = eps / int(level[-1])
-        boundary_topo = boundary_topo.toposimplify(
-            epsilon=eps,
-            simplify_algorithm="dp",
-            prevent_oversimplify=True,
-        )
-        boundary_lyr = boundary_topo.to_gdf(crs=country_adm0.crs)
+        # simplify as a coverage so edges shared by neighbouring units stay identical,
+        # coverage_simplify only accepts polygons so anything else is passed through
+        geoms = np.array(boundary_lyr.geometry.values, dtype=object)
+        polygonal = np.isin(
+            shapely.get_type_id(geoms),
+            [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON],
+        ) & ~shapely.is_empty(geoms)
+        geoms[polygonal] = shapely.coverage_simplify(geoms[polygonal], tolerance=eps)
 
         # make sure geometry is valid
-        for i, _ in boundary_lyr.iterrows():
-            if not boundary_lyr.geometry[i].is_valid:
-                boundary_lyr.geometry[i] = make_valid(boundary_lyr.geometry[i])
-            if boundary_lyr.geometry[i].geometryType() == "GeometryCollection":
-                new_geom = []
-                for part in boundary_lyr.geometry[i].geoms:
-                    if part.geometryType() in ["Polygon", "MultiPolygon"]:
-                        new_geom.append(part)
-                if len(new_geom) == 0:
-                    logger.error(f"{iso}: Boundary found with no geometry")
-                if len(new_geom) == 1:
-                    new_geom = new_geom[0]
-                else:
-                    new_geom = MultiPolygon(new_geom)
-                boundary_lyr.geometry[i] = new_geom
+        invalid = ~shapely.is_valid(geoms)
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+        collections = shapely.get_type_id(geoms) == shapely.GeometryType.GEOMETRYCOLLECTION
+        if collections.any():
+            geoms[collections] = keep_polygon_parts(geoms[collections])
+        empty_count = (shapely.is_missing(geoms) | shapely.is_empty(geoms)).sum()
+        if empty_count > 0:
+            logger.error(f"{iso}: Found {empty_count} boundaries with no geometry")
+        boundary_lyr = boundary_lyr.set_geometry(
+            GeoSeries(geoms, index=boundary_lyr.index, crs=country_adm0.crs)
+        )
 
         # clip international boundary to UN admin0 country boundary
-        boundary_lyr = boundary_lyr.clip(mask=country_adm0, keep_geom_type=True)
+        # only features whose envelope crosses the country edge need a full clip
+        country_geom = shapely.union_all(country_adm0.geometry.values)
+        country_edge = shapely.boundary(country_geom)
+        envelopes = shapely.envelope(boundary_lyr.geometry.values)
+        if country_edge is None:
+            crosses = np.ones(len(boundary_lyr), dtype=bool)
+        else:
+            crosses = shapely.intersects(country_edge, envelopes)
+        inside = ~crosses & shapely.intersects(country_geom, envelopes)
+        clipped = boundary_lyr.loc[crosses].clip(mask=country_adm0, keep_geom_type=True)
+        boundary_lyr = concat([boundary_lyr.loc[inside], clipped]).sort_index()
         return boundary_lyr
 
     def replace_country_boundaries(self, boundaries, iso, level, geom_type):
-        global_bounds = self.boundaries[f"{level}_{geom_type}"][
-            self.boundaries[f"{level}_{geom_type}"]["alpha_3"] != iso
-            ]
-        global_bounds = global_bounds.append(boundaries)
-        global_bounds.sort_values(by=[f"ADM{level[-1]}_PCODE"], inplace=True)
-        self.boundaries[f"{level}_{geom_type}"] = global_bounds
+        # stash the update, global files are rebuilt once in flush_pending
+        self._pending_updates.setdefault((level, geom_type), []).append((iso, boundaries))
+
+    def flush_pending(self):
+        for (level, geom_type), updates in self._pending_updates.items():
+            global_bounds = self.boundaries[f"{level}_{geom_type}"]
+            updated_isos = [iso for iso, _ in updates]
+            alpha_3 = global_bounds["alpha_3"].cat
+            updated_codes = alpha_3.categories.get_indexer(updated_isos)
+            replaced = np.isin(alpha_3.codes.to_numpy(), updated_codes[updated_codes >= 0])
+            global_bounds = concat(
+                [global_bounds[~replaced]] + [boundaries for _, boundaries in updates],
+                ignore_index=True,
+            )
+            global_bounds["alpha_3"] = global_bounds["alpha_3"].astype("category")
+            global_bounds.sort_values(by=[f"ADM{level[-1]}_PCODE"], inplace=True)
+            self.boundaries[f"{level}_{geom_type}"] = global_bounds
+        self._pending_updates = dict()
 
     def update_subnational_boundaries(self, country, levels, do_not_process):
         iso = country["#country+code+v_iso3"]
+        updated = []
         if iso in do_not_process:
             logger.warning(f"{iso}: Not processing for now")
-            return None
+            return updated
 
         logger.info(f"{iso}: Processing {','.join(levels)} boundaries")
 
         # find the correct admin boundary dataset
-        dataset_name = self.exceptions["dataset"].get(iso, f"cod-em-{iso.lower()}")
-        dataset = Dataset.read_from_hdx(dataset_name)
-        if not dataset:
-            dataset = Dataset.read_from_hdx(f"cod-ab-{iso.lower()}")
+        if iso in self.datasets:
+            dataset = self.datasets[iso]
+        else:
+            dataset = self.read_boundary_dataset(iso)
         if not dataset:
             logger.error(f"{iso}: Could not find boundary dataset")
-            return None
+            return updated
 
         country_adm0 = self.create_national_boundary(iso)
 
@@ -254,7 +416,7 @@ class Boundaries:
                 continue
 
             # read file and check projection
-            boundary_lyr = read_file(boundary_shp)
+            boundary_lyr = read_file(boundary_shp, engine="pyogrio")
             if not boundary_lyr.crs:
                 boundary_lyr = boundary_lyr.set_crs(crs="EPSG:4326")
             if not boundary_lyr.crs.name == "WGS 84":
@@ -279,17 +441,19 @@ class Boundaries:
             boundary_lyr = self.update_geometry(boundary_lyr, country_adm0, iso, level)
 
             # convert polygon boundaries to point
-            points = GeoDataFrame(boundary_lyr.representative_point())
-            points.rename(columns={0: "geometry"}, inplace=True)
-            points[req_fields] = boundary_lyr[req_fields]
-            points = points.set_geometry("geometry")
-
-            # replace boundaries in global files
-            self.replace_country_boundaries(boundary_lyr, iso, level, "polygon")
-            self.replace_country_boundaries(points, iso, level, "point")
+            points = boundary_lyr.set_geometry(
+                GeoSeries(
+                    shapely.point_on_surface(boundary_lyr.geometry.values),
+                    index=boundary_lyr.index,
+                    crs=boundary_lyr.crs,
+                )
+            )
 
+            updated.append((boundary_lyr, points, iso, level))
             logger.info(f"{iso}: Finished processing {level} boundaries")
 
+        return updated
+
     def update_subnational_resources(self, dataset_name, levels):
         dataset = Dataset.read_from_hdx(dataset_name)
         for level in levels:
@@ -297,9 +461,9 @@ class Boundaries:
             polygon_name = [key for key in self.boundary_names if self.boundary_names[key] == f"{level}_polygon"][0]
             point_name = [key for key in self.boundary_names if self.boundary_names[key] == f"{level}_point"][0]
             polygon_file = join(self.temp_folder, polygon_name)
-            self.boundaries[f"{level}_polygon"].to_file(polygon_file, driver="GeoJSON")
+            write_dataframe(self.boundaries[f"{level}_polygon"], polygon_file, driver="GeoJSON")
             point_file = join(self.temp_folder, point_name)
-            self.boundaries[f"{level}_point"].to_file(point_file, driver="GeoJSON")
+            write_dataframe(self.boundaries[f"{level}_point"], point_file, driver="GeoJSON")
 
             resource_polygon = [r for r in dataset.get_resources() if r["name"] == polygon_name][0]
             resource_polygon.set_file_to_upload(polygon_file)
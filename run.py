@@ -1,6 +1,10 @@
 import argparse
 import logging
+import multiprocessing
+import sys
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count, getpid, makedirs
 from os.path import expanduser, join
 from shapely.errors import ShapelyDeprecationWarning
 
@@ -18,6 +22,27 @@ warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning)
 
 lookup = "hdx-scraper-viz-inputs"
 
+_boundaries = None
+
+
+def _can_fork():
+    # workers rely on inheriting the HDX configuration set up by facade, which needs fork;
+    # fork is unavailable on Windows and unsafe on macOS once threads and SSL have been used
+    return "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin"
+
+
+def _init_worker(boundaries):
+    # give each worker its own copy of the global boundaries and its own unzip folder
+    # workers are forked so they inherit the HDX configuration and boundaries are not pickled
+    global _boundaries
+    _boundaries = boundaries
+    _boundaries.temp_folder = join(_boundaries.temp_folder, f"worker_{getpid()}")
+    makedirs(_boundaries.temp_folder, exist_ok=True)
+
+
+def _process_country(country, levels, do_not_process):
+    return _boundaries.update_subnational_boundaries(country, levels, do_not_process)
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -53,12 +78,33 @@ def main(
             )
 
             boundaries.download_boundary_inputs(levels)
-            for country in countries:
-                boundaries.update_subnational_boundaries(
-                    countries[country],
-                    levels,
-                    configuration.get("do_not_process", []),
-                )
+            do_not_process = configuration.get("do_not_process", [])
+            boundaries.find_boundary_datasets(countries, do_not_process)
+            if _can_fork():
+                with ProcessPoolExecutor(
+                    max_workers=cpu_count(),
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_worker,
+                    initargs=(boundaries,),
+                ) as executor:
+                    futures = [
+                        executor.submit(_process_country, countries[country], levels, do_not_process)
+                        for country in countries
+                    ]
+                    results = [future.result() for future in futures]
+            else:
+                logger.info("Cannot safely fork worker processes, processing countries one at a time")
+                results = [
+                    boundaries.update_subnational_boundaries(countries[country], levels, do_not_process)
+                    for country in countries
+                ]
+
+            # replace boundaries in global files in the parent process only
+            for updated in results:
+                for boundary_lyr, points, iso, level in updated:
+                    boundaries.replace_country_boundaries(boundary_lyr, iso, level, "polygon")
+                    boundaries.replace_country_boundaries(points, iso, level, "point")
+            boundaries.flush_pending()
             boundaries.update_subnational_resources(configuration["UN_boundaries"]["dataset"], levels)
             logger.info("Finished processing!")
 